@@ -4,44 +4,84 @@ BC FSR Road Segment Merger
 Loads BC road data and merges Forest Service Road segments
 """
 
+import argparse
 import geopandas as gpd
+import logging
+import numpy as np
+import os
 import pandas as pd
-import re
-from shapely.ops import linemerge
+import shapely
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import sys
 
-def filter_fsr_segments(gdf):
-    """Fast filter for FSR segments using vectorized operations"""
-    print("Filtering for FSR segments...")
+# Row filter pushed down into read_parquet, so pyarrow drops non-FSR rows
+# before any geometries are built; same test as filter_fsr_segments
+FSR_FILTER = (pc.field('ROAD_CLASS') == 'resource') & pc.match_substring(
+    pc.field('ROAD_NAME_FULL'), 'FSR', ignore_case=True)
+
+logger = logging.getLogger(__name__)
+
+def filter_fsr_segments(gdf, total_segments=None):
+    """Fast filter for FSR segments using vectorized operations
+    
+    gdf may already have been narrowed down at load time; total_segments is
+    the size of the full dataset, for reporting (defaults to len(gdf)).
+    """
+    if total_segments is None:
+        total_segments = len(gdf)
+    
+    logger.info("Filtering for FSR segments...")
     
     # First filter: ROAD_CLASS must be "resource" 
-    resource_mask = gdf['ROAD_CLASS'] == 'resource'
-    print(f"Found {resource_mask.sum()} segments with ROAD_CLASS='resource'")
+    # (Arrow string columns give <NA> for missing values, so fill those)
+    resource_mask = (gdf['ROAD_CLASS'] == 'resource').fillna(False)
+    logger.info("%s of %s loaded segments have ROAD_CLASS='resource'", resource_mask.sum(), len(gdf))
     
     # Second filter: ROAD_NAME_FULL must contain "FSR"
-    # Use vectorized string operations for speed
-    fsr_mask = gdf['ROAD_NAME_FULL'].str.contains('FSR', case=False, na=False)
+    # Use vectorized string operations for speed - uppercase the names once
+    # so the match is a plain case-sensitive substring scan in pyarrow compute
+    names_upper = gdf['ROAD_NAME_FULL'].str.upper()
+    fsr_mask = names_upper.str.contains('FSR', regex=False, na=False)
     
     # Combine both conditions
-    fsr_segments = gdf[resource_mask & fsr_mask].copy()
+    # (no .copy() - nothing downstream mutates the filtered frame in place)
+    fsr_segments = gdf[resource_mask & fsr_mask]
     
-    print(f"Found {len(fsr_segments)} FSR segments out of {len(gdf)} total segments")
-    print(f"Unique FSRs: {fsr_segments['ROAD_NAME_FULL'].nunique()}")
+    logger.info("Found %s FSR segments out of %s total segments", len(fsr_segments), total_segments)
+    logger.info("Unique FSRs: %s", fsr_segments['ROAD_NAME_FULL'].nunique())
     
     return fsr_segments
 
+def top_counts(counts, k):
+    """Indices of the k largest counts, largest first
+    
+    A partial partition finds the k-th largest count in O(N) instead of
+    sorting every count. Ties are broken by position, as Series.nlargest does.
+    """
+    k = min(k, len(counts))
+    kth = np.partition(counts, len(counts) - k)[len(counts) - k]
+    above = np.flatnonzero(counts > kth)
+    ties = np.flatnonzero(counts == kth)[:k - len(above)]
+    top = np.concatenate([above, ties])
+    return top[np.argsort(-counts[top], kind='stable')]
+
 def explore_fsr_data(fsr_gdf, output_file="fsr_analysis.txt"):
     """Analyze FSR data and save results"""
-    print("Analyzing FSR data...")
+    logger.info("Analyzing FSR data...")
     
-    # Get FSR statistics
-    fsr_names = fsr_gdf['ROAD_NAME_FULL'].unique()
-    segment_counts = fsr_gdf.groupby('ROAD_NAME_FULL').size()
+    # Get FSR statistics - factorize hashes the names once (sorting only the
+    # unique ones) and bincount tallies the integer codes in a single C pass
+    codes, fsr_names = fsr_gdf['ROAD_NAME_FULL'].factorize(sort=True)
+    fsr_names = fsr_names.to_numpy()
+    counts = np.bincount(codes, minlength=len(fsr_names))
+    segment_counts = pd.Series(counts, index=fsr_names)
     
-    print(f"Found {len(fsr_names)} unique FSRs")
-    print(f"Total FSR segments: {len(fsr_gdf)}")
-    print(f"Average segments per FSR: {len(fsr_gdf) / len(fsr_names):.1f}")
+    logger.info("Found %s unique FSRs", len(fsr_names))
+    logger.info("Total FSR segments: %s", len(fsr_gdf))
+    logger.info("Average segments per FSR: %.1f", len(fsr_gdf) / len(fsr_names))
     
     # Save detailed analysis
     with open(output_file, 'w') as f:
@@ -53,135 +93,252 @@ def explore_fsr_data(fsr_gdf, output_file="fsr_analysis.txt"):
         
         f.write("FSRs with most segments:\n")
         f.write("-" * 30 + "\n")
-        top_fsrs = segment_counts.nlargest(20)
-        for fsr_name, count in top_fsrs.items():
-            f.write(f"{fsr_name}: {count} segments\n")
+        f.write("".join(f"{fsr_names[i]}: {counts[i]} segments\n" for i in top_counts(counts, 20)))
         
         f.write("\n\nAll FSR Names:\n")
         f.write("-" * 20 + "\n")
-        for name in sorted(fsr_names):
-            f.write(f"{name}\n")
+        f.write("\n".join(fsr_names))
+        f.write("\n")
     
-    print(f"Analysis saved to {output_file}")
+    logger.info("Analysis saved to %s", output_file)
     
-    # Show top FSRs in console
-    print("\nTop 10 FSRs by segment count:")
-    top_10 = segment_counts.nlargest(10)
-    for fsr_name, count in top_10.items():
-        print(f"  {fsr_name}: {count} segments")
+    # Show top FSRs in console - only build the listing if it will be shown
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("\nTop 10 FSRs by segment count:\n%s", "\n".join(
+            f"  {fsr_names[i]}: {counts[i]} segments" for i in top_counts(counts, 10)))
     
     return segment_counts
 
-def merge_fsr_segments(fsr_gdf):
-    """Efficiently merge FSR segments by road name"""
-    print("\nMerging FSR segments by ROAD_NAME_FULL...")
-    print("\n(duplicating ROAD_NAME_FULL attribute to title attribute for caltopo.)")
-    
-    merged_fsrs = []
-    
-    # Group by ROAD_NAME_FULL - this is O(N log N) where N is FSR segments only
-    for road_name, group in fsr_gdf.groupby('ROAD_NAME_FULL'):
-        try:
-            # Get all geometries for this FSR
-            geometries = group.geometry.tolist()
-            
-            # Merge contiguous segments - linemerge handles the connectivity
-            merged_geom = linemerge(geometries)
-            
-            # Calculate some statistics
-            total_length = group.geometry.length.sum()
-            
-            merged_fsrs.append({
-                'title': road_name, # caltopo likes title 
-                'ROAD_NAME_FULL': road_name,  # but leave the BC attribute name also
-                'ROAD_CLASS': 'resource',  # All FSRs have this
-                'original_segments': len(group),
-                'total_length_m': total_length,
-                'geometry': merged_geom
-            })
-            
-        except Exception as e:
-            print(f"Error merging {road_name}: {e}")
-            continue
+def parallel_line_merge(multilines, workers=None):
+    """Run shapely.line_merge over chunks of the array in a thread pool
+    
+    Shapely's vectorized functions release the GIL while GEOS works, so the
+    independent FSRs merge on all cores instead of one.
+    """
+    workers = min(workers or os.cpu_count() or 1, len(multilines))
+    chunks = np.array_split(multilines, workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return np.concatenate(list(executor.map(shapely.line_merge, chunks)))
+
+def merge_fsr_segments(fsr_gdf, simplify_tolerance=None):
+    """Efficiently merge FSR segments by road name
     
-    if not merged_fsrs:
-        print("No FSR segments could be merged!")
+    If simplify_tolerance is given (in CRS units), the merged lines are
+    Douglas-Peucker simplified to shrink the output for caltopo.
+    """
+    logger.info("\nMerging FSR segments by ROAD_NAME_FULL...")
+    logger.info("\n(duplicating ROAD_NAME_FULL attribute to title attribute for caltopo.)")
+    
+    # Group by ROAD_NAME_FULL without a pandas groupby: factorize the names
+    # into sorted integer codes and sort the segments so each FSR is one
+    # contiguous run. Unnamed segments (code -1) don't belong to any FSR.
+    codes, road_names = fsr_gdf['ROAD_NAME_FULL'].factorize(sort=True)
+    if len(road_names) == 0:
+        logger.warning("No FSR segments could be merged!")
         return None
     
-    # Create new GeoDataFrame with merged FSRs
-    result_gdf = gpd.GeoDataFrame(merged_fsrs, crs=fsr_gdf.crs)
+    order = np.argsort(codes, kind='stable')
+    order = order[codes[order] >= 0]
+    sorted_codes = codes[order]
+    edges = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    segment_counts = np.diff(np.r_[edges, len(sorted_codes)])
+    geometries = fsr_gdf.geometry.values[order]
+    
+    # Measure every segment in one vectorized call and sum each FSR's run,
+    # rather than a GEOS call per road. Null geometries measure NaN; count
+    # them as zero like groupby's sum did.
+    total_lengths = np.add.reduceat(np.nan_to_num(shapely.length(geometries)), edges)
+    
+    # Flatten any multi-part input so every part is a LineString, tagged
+    # with its FSR's code; get_parts keeps the input order, so each FSR's
+    # parts are still one contiguous slice
+    parts, part_index = shapely.get_parts(geometries, return_index=True)
+    part_codes = sorted_codes[part_index]
+    part_counts = np.bincount(part_codes, minlength=len(road_names))
+    merged_geoms = np.empty(len(road_names), dtype=object)
+    
+    # Most FSRs are a single segment - pass those straight through instead
+    # of paying for a line_merge that has nothing to join
+    single_part = part_counts[part_codes] == 1
+    merged_geoms[part_codes[single_part]] = parts[single_part]
     
-    total_original = sum(f['original_segments'] for f in merged_fsrs)
+    # Build one MultiLineString per remaining FSR in a single vectorized call
+    # instead of a Python loop. indices must be dense and ascending, so
+    # renumber the multi-segment FSRs.
+    multi_groups = np.flatnonzero(part_counts > 1)
+    if len(multi_groups) > 0:
+        multi_codes = np.searchsorted(multi_groups, part_codes[~single_part])
+        multilines = shapely.multilinestrings(parts[~single_part], indices=multi_codes)
+        
+        # Merge contiguous segments - line_merge handles the connectivity and
+        # loops over each chunk of the array in C
+        merged_geoms[multi_groups] = parallel_line_merge(multilines)
+    
+    # FSRs whose segments all have null geometry have nothing for caltopo
+    # to draw, so leave them out of the output
+    has_geometry = part_counts > 0
+    if not has_geometry.all():
+        logger.warning("Skipping %s FSRs with no geometry", int((~has_geometry).sum()))
+        road_names = road_names[has_geometry]
+        segment_counts = segment_counts[has_geometry]
+        total_lengths = total_lengths[has_geometry]
+        merged_geoms = merged_geoms[has_geometry]
+        if len(road_names) == 0:
+            logger.warning("No FSR segments could be merged!")
+            return None
+    
+    # Drop vertices caltopo doesn't need to draw the road - fewer vertices
+    # means a smaller output file and less time formatting it
+    if simplify_tolerance is not None:
+        merged_geoms = shapely.simplify(merged_geoms, simplify_tolerance, preserve_topology=False)
+    
+    # Create new GeoDataFrame with merged FSRs straight from the per-FSR
+    # column arrays - no per-row dicts, and the geometries are wrapped in a
+    # GeometryArray up front so the constructor doesn't have to infer them
+    result_gdf = gpd.GeoDataFrame({
+        'title': road_names,  # caltopo likes title
+        'ROAD_NAME_FULL': road_names,  # but leave the BC attribute name also
+        'ROAD_CLASS': 'resource',  # All FSRs have this
+        'original_segments': segment_counts.astype(np.int32),
+        'total_length_m': total_lengths.astype(np.float64, copy=False),
+        'geometry': gpd.array.from_shapely(merged_geoms, crs=fsr_gdf.crs),
+    })
+    
+    total_original = int(result_gdf['original_segments'].sum())
     reduction_pct = ((total_original - len(result_gdf)) / total_original * 100)
     
-    print(f"Merged {total_original} segments into {len(result_gdf)} FSR roads")
-    print(f"Reduction: {reduction_pct:.1f}%")
-    print(f"Average segments per FSR: {total_original / len(result_gdf):.1f}")
+    logger.info("Merged %s segments into %s FSR roads", total_original, len(result_gdf))
+    logger.info("Reduction: %.1f%%", reduction_pct)
+    logger.info("Average segments per FSR: %.1f", total_original / len(result_gdf))
     
     return result_gdf
 
+def ensure_binary(geojson_file, binary_file="bc_roads.parquet"):
+    """Convert the GeoJSON input to GeoParquet once and return the file to read"""
+    source = Path(geojson_file)
+    binary = Path(binary_file)
+    
+    # Reuse the converted copy unless the GeoJSON has been replaced since
+    if binary.exists() and binary.stat().st_mtime >= source.stat().st_mtime:
+        return binary_file
+    
+    logger.info("Converting %s to %s (only needed once)...", geojson_file, binary_file)
+    gdf = gpd.read_file(geojson_file, engine='pyogrio')
+    
+    # Write to a sibling file and move it into place, so an interrupted
+    # conversion can't leave a truncated cache that looks up to date
+    tmp_file = binary.with_name(binary.name + ".tmp")
+    try:
+        gdf.to_parquet(tmp_file)
+        os.replace(tmp_file, binary)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+    return binary_file
+
+def non_negative_float(value):
+    """argparse type for --simplify: a finite, non-negative float"""
+    try:
+        tolerance = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid tolerance: {value!r}")
+    if not np.isfinite(tolerance) or tolerance < 0:
+        raise argparse.ArgumentTypeError(f"tolerance must be a non-negative number, got {value!r}")
+    return tolerance
+
 def main():
     """Main execution function"""
+    parser = argparse.ArgumentParser(description="Merge BC Forest Service Road segments for caltopo")
+    parser.add_argument('--simplify', type=non_negative_float, metavar='TOLERANCE',
+                        help="simplify merged roads to this tolerance in CRS units "
+                             "(metres for BC Albers); default keeps every vertex")
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="only report warnings and errors")
+    args = parser.parse_args()
+    
+    # Progress goes through logging so --quiet can gate it off entirely.
+    # Progress goes to stdout, warnings and errors (with tracebacks) to
+    # stderr; the root logger stays at WARNING so library chatter (pyogrio
+    # etc.) is hidden
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.addFilter(lambda record: record.levelno < logging.WARNING)
+    stderr_handler = logging.StreamHandler(sys.stderr)
+    stderr_handler.setLevel(logging.WARNING)
+    logging.basicConfig(format='%(message)s', handlers=[stdout_handler, stderr_handler])
+    logger.setLevel(logging.WARNING if args.quiet else logging.INFO)
+    
     # Check for input file
     geojson_file = "bc_roads.geojson"
     
     if not Path(geojson_file).exists():
-        print(f"Error: {geojson_file} not found!")
-        print("Please download BC road data and save as 'bc_roads.geojson'")
+        logger.error("Error: %s not found!", geojson_file)
+        logger.error("Please download BC road data and save as 'bc_roads.geojson'")
         return
     
     try:
-        print(f"Loading {geojson_file}...")
-        gdf = gpd.read_file(geojson_file)
-        print(f"Loaded {len(gdf)} road segments")
+        # Parsing GeoJSON dominates load time, so read from a binary copy
+        road_file = ensure_binary(geojson_file)
         
-        # Show column information
-        print(f"\nDataset columns: {list(gdf.columns)}")
-        print(f"CRS: {gdf.crs}")
+        # Show column information - the Parquet footer has the schema and
+        # row count, so no data is read yet
+        metadata = pq.read_metadata(road_file)
+        available_cols = metadata.schema.names
+        logger.info("\nDataset columns: %s", available_cols)
         
         # Check for required columns
         required_cols = ['ROAD_NAME_FULL', 'ROAD_CLASS']
-        missing_cols = [col for col in required_cols if col not in gdf.columns]
+        missing_cols = [col for col in required_cols if col not in available_cols]
         if missing_cols:
-            print(f"Error: Missing required columns: {missing_cols}")
-            print("Available columns:", list(gdf.columns))
+            logger.error("Error: Missing required columns: %s", missing_cols)
+            logger.error("Available columns: %s", available_cols)
             return
         
+        # Only read the columns we use, and let pyarrow filter the rows
+        logger.info("Loading %s...", road_file)
+        gdf = gpd.read_parquet(road_file, columns=required_cols + ['geometry'], filters=FSR_FILTER)
+        logger.info("Loaded %s candidate FSR segments out of %s road segments", len(gdf), metadata.num_rows)
+        logger.info("CRS: %s", gdf.crs.to_string() if gdf.crs else None)
+        
+        # Store the string columns we filter on as Arrow strings so the
+        # comparisons run over contiguous UTF-8 buffers, not Python objects
+        for col in required_cols:
+            gdf[col] = gdf[col].astype('string[pyarrow]')
+        
         # Filter for FSR segments only - this is the key optimization
-        fsr_segments = filter_fsr_segments(gdf)
+        fsr_segments = filter_fsr_segments(gdf, total_segments=metadata.num_rows)
         
         if len(fsr_segments) == 0:
-            print("No FSR segments found!")
+            logger.warning("No FSR segments found!")
             return
         
         # Analyze FSR data
         segment_counts = explore_fsr_data(fsr_segments)
         
         # Merge FSR segments - now only working with ~3000 segments instead of 50000
-        merged_fsrs = merge_fsr_segments(fsr_segments)
+        merged_fsrs = merge_fsr_segments(fsr_segments, simplify_tolerance=args.simplify)
         
         if merged_fsrs is not None:
             # Save results
             output_file = "bc_fsrs_merged.geojson"
-            merged_fsrs.to_file(output_file, driver='GeoJSON')
-            print(f"\nMerged FSR roads saved to {output_file}")
+            # Stay with GeoJSON since that is what caltopo imports, but write it
+            # with pyogrio's compiled writer rather than fiona
+            merged_fsrs.to_file(output_file, driver='GeoJSON', engine='pyogrio')
+            logger.info("\nMerged FSR roads saved to %s", output_file)
             
             # Show final statistics
-            print("\nFinal Results:")
-            print(f"Original FSR segments: {len(fsr_segments)}")
-            print(f"Merged FSR roads: {len(merged_fsrs)}")
-            print(f"Reduction: {((len(fsr_segments) - len(merged_fsrs)) / len(fsr_segments) * 100):.1f}%")
+            logger.info("\nFinal Results:")
+            logger.info("Original FSR segments: %s", len(fsr_segments))
+            logger.info("Merged FSR roads: %s", len(merged_fsrs))
+            logger.info("Reduction: %.1f%%", (len(fsr_segments) - len(merged_fsrs)) / len(fsr_segments) * 100)
             
             # Show top 20 FSRs by segment count
-            top_fsrs = merged_fsrs.nlargest(20, 'original_segments')
-            print(f"\nTop 20 FSRs by original segment count:")
-            for _, row in top_fsrs.iterrows():
-                print(f"  {row['ROAD_NAME_FULL']}: {row['original_segments']} segments")
+            if logger.isEnabledFor(logging.INFO):
+                top_fsrs = merged_fsrs.nlargest(20, 'original_segments')
+                logger.info("\nTop 20 FSRs by original segment count:\n%s", "\n".join(
+                    f"  {name}: {count} segments"
+                    for name, count in zip(top_fsrs['ROAD_NAME_FULL'], top_fsrs['original_segments'])))
     
     except Exception as e:
-        print(f"Error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error: %s", e)
         return
 
 if __name__ == "__main__":